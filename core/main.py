@@ -6,7 +6,7 @@ from fastapi.responses import JSONResponse
 
 from core.routers import users, tasks_lists, tasks
 from core.models import User
-from core.database import get_db_session, engine
+from core.database import get_db_session, create_tables
 from core.schemas import UserCreate
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -28,8 +28,7 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 
 @app.on_event("startup")
 async def on_startup():
-    async with engine.begin() as conn:
-        await conn.run_sync(SQLModel.metadata.create_all)
+    await create_tables()
 
 
 @app.get("/")
@@ -51,3 +51,29 @@ class Task(SQLModel, table=True):
 
     user: User = Relationship(back_populates="tasks")
     tasks_list: TasksList = Relationship(back_populates="tasks")
+
+
+class UserDirectory(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    username: str = Field(unique=True, nullable=False)
+    shard_id: int = Field(nullable=False)
+    moving: bool = Field(default=False)
+
+
+class TasksListDirectory(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    list_title: str = Field(unique=True, nullable=False)
+    user_id: int = Field(foreign_key="userdirectory.id")
+
+
+class TaskDirectory(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(foreign_key="userdirectory.id")
+
+
+class IdempotencyRecord(SQLModel, table=True):
+    key: str = Field(primary_key=True)
+    fingerprint: str = Field(nullable=False)
+    response: Optional[str] = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime = Field(nullable=False, index=True)
@@ -0,0 +1,265 @@
+"""
+fills the directory from the rows already on the shards, run it once when
+upgrading a deployment that predates sharding (it is safe to repeat)
+
+    python -m core.rebalance backfill [--reassign-foreign-tasks]
+
+tasks that were added to another user's list are reported, or with the flag
+handed over to the list owner, since a user's tasks must share their shard
+
+moves a user, with all of their tasks lists and tasks, to another shard
+
+    python -m core.rebalance <username> <target_shard_id>
+
+the user is fenced (writes get 503) while the copy is made, the directory is
+switched and unfenced in one commit, and the rows on every other shard are
+removed afterwards; an interrupted run is finished by running it again, until
+then the user stays fenced
+"""
+import asyncio
+import sys
+
+from sqlalchemy import delete, func, or_, text, update
+from sqlmodel import select
+
+from core.database import async_session, shard_session, shard_sessions
+from core.models import (
+    User,
+    TasksList,
+    Task,
+    UserDirectory,
+    TasksListDirectory,
+    TaskDirectory,
+)
+
+# commit_user_write checks the fence right before committing; this covers a
+# commit that is between that check and the shard commit when the fence is set
+FENCE_GRACE_SECONDS = 5
+
+
+async def _delete_user_rows(db, user_id: int) -> None:
+    await db.execute(delete(Task).where(Task.created_by == user_id))
+    await db.execute(delete(TasksList).where(TasksList.created_by == user_id))
+    await db.execute(delete(User).where(User.id == user_id))
+
+
+def _foreign_tasks_query():
+    """
+    tasks added to another user's list, allowed before tasks had to live on
+    their owner's shard; they tie two users to one shard
+    """
+    return (
+        select(Task.id, TasksList.created_by)
+        .join(TasksList, Task.related_task_list == TasksList.id)
+        .where(Task.created_by != TasksList.created_by)
+    )
+
+
+async def _foreign_task_ids(shard_id: int, user_id: int) -> list[int]:
+    async with shard_session(shard_id) as db:
+        result = await db.execute(
+            _foreign_tasks_query().where(
+                or_(Task.created_by == user_id, TasksList.created_by == user_id)
+            )
+        )
+        return [task_id for task_id, _ in result.all()]
+
+
+async def _set_moving(directory, entry: UserDirectory, moving: bool) -> None:
+    entry.moving = moving
+    directory.add(entry)
+    await directory.commit()
+
+
+async def _copy_user(user_id: int, source_shard_id: int, target_shard_id: int) -> None:
+    async with shard_session(source_shard_id) as source:
+        user = await source.get(User, user_id)
+        if not user:
+            raise ValueError(f"User {user_id} not found on shard {source_shard_id}")
+
+        result = await source.execute(
+            select(TasksList).where(TasksList.created_by == user.id)
+        )
+        tasks_lists = result.scalars().all()
+        result = await source.execute(select(Task).where(Task.created_by == user.id))
+        tasks = result.scalars().all()
+
+    async with shard_session(target_shard_id) as target:
+        # leftovers of an earlier interrupted run
+        await _delete_user_rows(target, user_id)
+
+        target.add(User(**user.model_dump()))
+        await target.flush()
+        target.add_all(
+            [TasksList(**tasks_list.model_dump()) for tasks_list in tasks_lists]
+        )
+        await target.flush()
+        target.add_all([Task(**task.model_dump()) for task in tasks])
+        await target.commit()
+
+
+async def move_user(username: str, target_shard_id: int) -> None:
+    if not 0 <= target_shard_id < len(shard_sessions):
+        raise ValueError(f"Shard {target_shard_id} is not configured")
+
+    async with async_session() as directory:
+        result = await directory.execute(
+            select(UserDirectory).where(UserDirectory.username == username)
+        )
+        entry = result.scalars().first()
+        if not entry:
+            raise ValueError(f"User {username} not found")
+
+        if entry.shard_id != target_shard_id:
+            # checked before fencing, so a move that cannot succeed never locks
+            # the user out (and a fence left by such a move is lifted)
+            foreign_task_ids = await _foreign_task_ids(entry.shard_id, entry.id)
+            if foreign_task_ids:
+                if entry.moving:
+                    await _set_moving(directory, entry, False)
+                raise ValueError(
+                    f"User {username} shares tasks {foreign_task_ids} with other "
+                    "users' lists, reassign them before moving"
+                )
+
+            if not entry.moving:
+                await _set_moving(directory, entry, True)
+                await asyncio.sleep(FENCE_GRACE_SECONDS)
+
+            try:
+                await _copy_user(entry.id, entry.shard_id, target_shard_id)
+            except BaseException:
+                # the directory still points at the intact source shard
+                await _set_moving(directory, entry, False)
+                raise
+            entry.shard_id = target_shard_id
+
+        entry.moving = False
+        directory.add(entry)
+        await directory.commit()
+
+        # the directory points at the new shard, the rest are stale copies
+        for shard_id in range(len(shard_sessions)):
+            if shard_id == entry.shard_id:
+                continue
+            async with shard_session(shard_id) as db:
+                await _delete_user_rows(db, entry.id)
+                await db.commit()
+
+
+async def _advance_id_sequence(directory, model) -> None:
+    """
+    ids inserted explicitly do not move a postgres serial sequence forward,
+    so the next reservation would collide with a backfilled id
+    sqlite already continues after the largest rowid
+    """
+    if directory.get_bind().dialect.name != "postgresql":
+        return
+    max_id = (await directory.execute(select(func.max(model.id)))).scalar()
+    if max_id is None:
+        return
+    table = model.__tablename__
+    await directory.execute(
+        text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), :max_id)"),
+        {"max_id": max_id},
+    )
+
+
+async def _reassign_foreign_tasks(shard_id: int, reassign: bool) -> None:
+    async with shard_session(shard_id) as db:
+        foreign_tasks = (await db.execute(_foreign_tasks_query())).all()
+        if not foreign_tasks:
+            return
+        if not reassign:
+            raise ValueError(
+                f"Tasks {[task_id for task_id, _ in foreign_tasks]} on shard "
+                f"{shard_id} belong to another user's list, rerun with "
+                "--reassign-foreign-tasks to give them to the list owner"
+            )
+        for task_id, list_owner_id in foreign_tasks:
+            await db.execute(
+                update(Task).where(Task.id == task_id).values(created_by=list_owner_id)
+            )
+        await db.commit()
+
+
+async def backfill(reassign_foreign_tasks: bool = False) -> None:
+    """
+    function to fill the directory from the existing shard rows
+    a user's tasks must live next to their lists, so tasks added to another
+    user's list are either reported or handed over to the list owner
+    """
+    for shard_id in range(len(shard_sessions)):
+        await _reassign_foreign_tasks(shard_id, reassign_foreign_tasks)
+
+    async with async_session() as directory:
+        known_users = {
+            entry.id: entry
+            for entry in (await directory.execute(select(UserDirectory))).scalars()
+        }
+        known_lists = set(
+            (await directory.execute(select(TasksListDirectory.id))).scalars()
+        )
+        known_tasks = set((await directory.execute(select(TaskDirectory.id))).scalars())
+
+        for shard_id in range(len(shard_sessions)):
+            async with shard_session(shard_id) as db:
+                users = (await db.execute(select(User))).scalars().all()
+                tasks_lists = (await db.execute(select(TasksList))).scalars().all()
+                tasks = (await db.execute(select(Task))).scalars().all()
+
+            for user in users:
+                entry = known_users.get(user.id)
+                if entry is None:
+                    entry = UserDirectory(
+                        id=user.id, username=user.username, shard_id=shard_id
+                    )
+                    directory.add(entry)
+                    known_users[user.id] = entry
+                elif entry.username != user.username:
+                    raise ValueError(
+                        f"User id {user.id} on shard {shard_id} is already "
+                        f"taken by {entry.username}"
+                    )
+            await directory.flush()
+
+            for tasks_list in tasks_lists:
+                if tasks_list.id not in known_lists:
+                    directory.add(
+                        TasksListDirectory(
+                            id=tasks_list.id,
+                            list_title=tasks_list.list_title,
+                            user_id=tasks_list.created_by,
+                        )
+                    )
+                    known_lists.add(tasks_list.id)
+            for task in tasks:
+                if task.id not in known_tasks:
+                    directory.add(TaskDirectory(id=task.id, user_id=task.created_by))
+                    known_tasks.add(task.id)
+            await directory.flush()
+
+        for model in (UserDirectory, TasksListDirectory, TaskDirectory):
+            await _advance_id_sequence(directory, model)
+        await directory.commit()
+
+
+def main(argv: list[str]) -> None:
+    if argv[:1] == ["backfill"] and argv[1:] in ([], ["--reassign-foreign-tasks"]):
+        asyncio.run(backfill(reassign_foreign_tasks=len(argv) == 2))
+        print("Directory backfilled")
+        return
+
+    if len(argv) != 2:
+        sys.exit(
+            "usage: python -m core.rebalance backfill [--reassign-foreign-tasks]\n"
+            "       python -m core.rebalance <username> <target_shard_id>"
+        )
+
+    username, target_shard_id = argv[0], int(argv[1])
+    asyncio.run(move_user(username, target_shard_id))
+    print(f"User {username} is on shard {target_shard_id}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -5,10 +5,19 @@ from fastapi.responses import JSONResponse
 
 from core.schemas import TaskCreate, TaskPatch
 from sqlalchemy.ext.asyncio import AsyncSession
-from core.database import get_db_session
+from core.database import (
+    bind_user,
+    commit_user_write,
+    get_db_session,
+    get_directory_session,
+    shard_session,
+    user_entry_for_task_id,
+)
 from core.models import Task, TasksList, User
-from core.utils import auth
+from core.routers.tasks_lists import find_tasks_list
+from core.utils import auth, directory as directory_utils, idempotency
 from core.utils.auth import token_dependency
+from core.utils.idempotency import idempotency_key_dependency
 from datetime import datetime
 
 router = APIRouter()
@@ -46,21 +55,38 @@ async def find_task(task_id: int, db, user=None) -> Task | None:
 async def create_task(
     task: TaskCreate,
     token: str = Depends(token_dependency),
+    idempotency_key: str = Depends(idempotency_key_dependency),
     db: AsyncSession = Depends(get_db_session),
+    directory: AsyncSession = Depends(get_directory_session),
 ):
     user = await auth.validate_token(token, db)
-    new_task = Task(
-        task_title=task.task_title,
-        description=task.description,
-        related_task_list=task.list_id,
-        created_by=user.id,
-    )
 
-    db.add(new_task)
-    await db.commit()
-    await db.refresh(new_task)
+    async def handler():
+        # tasks live on their owner's shard, next to the list they belong to
+        await find_tasks_list(task.list_id, db, user)
+
+        entry = await directory_utils.reserve_task_id(user.id, directory)
+        new_task = Task(
+            id=entry.id,
+            task_title=task.task_title,
+            description=task.description,
+            related_task_list=task.list_id,
+            created_by=user.id,
+        )
+
+        db.add(new_task)
+        try:
+            await commit_user_write(db)
+        except BaseException:
+            await directory_utils.release(entry, directory)
+            raise
+        await db.refresh(new_task)
 
-    return {"message": "Task created successfully", "task": new_task}
+        return {"message": "Task created successfully", "task": new_task}
+
+    return await idempotency.run_idempotent(
+        idempotency_key, f"tasks:create:{user.username}", task, handler
+    )
 
 
 @router.delete("/{task_id}")
@@ -75,7 +101,7 @@ async def delete_task(
     task.deleted_at = datetime.utcnow()
 
     db.add(task)
-    await db.commit()
+    await commit_user_write(db)
     return JSONResponse(
         status_code=status.HTTP_200_OK, content={"message": "Task deleted successfully"}
     )
@@ -96,7 +122,7 @@ async def patch_task(
     existing_task.tasks_list.id = task.list_id
 
     db.add(existing_task)
-    await db.commit()
+    await commit_user_write(db)
     return JSONResponse(
         status_code=status.HTTP_200_OK, content={"message": "Task updated successfully"}
     )
@@ -107,14 +133,19 @@ async def done_task(
     task_id: int,
     token: str = Depends(token_dependency),
     db: AsyncSession = Depends(get_db_session),
+    directory: AsyncSession = Depends(get_directory_session),
 ):
     user = await auth.validate_token(token, db)
-    task = await find_task(task_id, db)
 
-    task.done = True
+    # any user may mark a task done, so it is looked up on its owner's shard
+    owner = await user_entry_for_task_id(task_id, directory)
+    async with shard_session(owner.shard_id) as task_db:
+        task = await find_task(task_id, task_db)
 
-    db.add(task)
-    await db.commit()
+        task.done = True
+
+        task_db.add(task)
+        await commit_user_write(bind_user(task_db, owner))
     return JSONResponse(
         status_code=status.HTTP_200_OK, content={"message": "Task done"}
     )
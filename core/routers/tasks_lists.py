@@ -6,10 +6,18 @@ from fastapi.responses import JSONResponse
 
 from core.schemas import TasksListCreate, TasksListPatch
 from sqlalchemy.ext.asyncio import AsyncSession
-from core.database import get_db_session
-from core.models import TasksList, User, Task
-from core.utils import auth
+from core.database import (
+    commit_user_write,
+    get_db_session,
+    get_directory_session,
+    shard_for_list_id,
+    shard_session,
+    shard_sessions,
+)
+from core.models import TasksList, TasksListDirectory, User, Task, UserDirectory
+from core.utils import auth, directory as directory_utils, idempotency
 from core.utils.auth import token_dependency
+from core.utils.idempotency import idempotency_key_dependency
 from datetime import datetime
 
 router = APIRouter()
@@ -42,9 +50,12 @@ async def find_tasks_list(list_id: int, db, user=None) -> TasksList | None:
     return tasks_list
 
 
-async def if_list_title_already_exists(list_title: str, db) -> None:
-    result = await db.execute(
-        select(TasksList).where(TasksList.list_title == list_title)
+async def if_list_title_already_exists(list_title: str, directory) -> None:
+    """
+    list titles are unique across all shards, so the check goes to the directory
+    """
+    result = await directory.execute(
+        select(TasksListDirectory).where(TasksListDirectory.list_title == list_title)
     )
     existing_tasks_list = result.scalars().first()
     if existing_tasks_list:
@@ -58,46 +69,88 @@ async def if_list_title_already_exists(list_title: str, db) -> None:
 async def create_tasks_list(
     tasks_list: TasksListCreate,
     token: str = Depends(token_dependency),
+    idempotency_key: str = Depends(idempotency_key_dependency),
     db: AsyncSession = Depends(get_db_session),
+    directory: AsyncSession = Depends(get_directory_session),
 ):
     user = await auth.validate_token(token, db)
-    await if_list_title_already_exists(tasks_list.list_title, db)
-
-    new_tasks_list = TasksList(
-        list_title=tasks_list.list_title,
-        description=tasks_list.description,
-        created_by=user.id,
-        created_at=datetime.utcnow(),
-        updated_at=datetime.utcnow(),
-    )
 
-    db.add(new_tasks_list)
-    await db.commit()
-    await db.refresh(new_tasks_list)
+    async def handler():
+        entry = await directory_utils.reserve_list_title(
+            tasks_list.list_title, user.id, directory
+        )
+
+        new_tasks_list = TasksList(
+            id=entry.id,
+            list_title=tasks_list.list_title,
+            description=tasks_list.description,
+            created_by=user.id,
+            created_at=datetime.utcnow(),
+            updated_at=datetime.utcnow(),
+        )
 
-    return {"message": "Tasks list created successfully", "tasks_list": new_tasks_list}
+        db.add(new_tasks_list)
+        try:
+            await commit_user_write(db)
+        except BaseException:
+            await directory_utils.release(entry, directory)
+            raise
+        await db.refresh(new_tasks_list)
+
+        return {
+            "message": "Tasks list created successfully",
+            "tasks_list": new_tasks_list,
+        }
+
+    return await idempotency.run_idempotent(
+        idempotency_key, f"tasks-lists:create:{user.username}", tasks_list, handler
+    )
 
 
 @router.get("/")
 async def get_tasks_lists(
-    token: str = Depends(token_dependency), db: AsyncSession = Depends(get_db_session)
+    token: str = Depends(token_dependency),
+    db: AsyncSession = Depends(get_db_session),
+    directory: AsyncSession = Depends(get_directory_session),
 ):
     user = await auth.validate_token(token, db)
     del user
 
-    result = await db.execute(select(TasksList))
-    tasks_lists = result.scalars().all()
-    return tasks_lists
+    tasks_lists = []
+    for shard_id in range(len(shard_sessions)):
+        async with shard_session(shard_id) as shard_db:
+            result = await shard_db.execute(select(TasksList))
+            tasks_lists.extend((shard_id, row) for row in result.scalars().all())
+
+    # skip copies left on a shard the owner has been moved away from
+    result = await directory.execute(
+        select(UserDirectory.id, UserDirectory.shard_id).where(
+            UserDirectory.id.in_({row.created_by for _, row in tasks_lists})
+        )
+    )
+    owner_shards = dict(result.all())
+    return sorted(
+        (
+            row
+            for shard_id, row in tasks_lists
+            if owner_shards.get(row.created_by) == shard_id
+        ),
+        key=lambda tasks_list: tasks_list.id,
+    )
 
 
 @router.get("/{list_id}")
-async def get_tasks_list(list_id: int, db: AsyncSession = Depends(get_db_session)):
-    tasks_list = await find_tasks_list(list_id, db)
+async def get_tasks_list(
+    list_id: int, directory: AsyncSession = Depends(get_directory_session)
+):
+    shard_id = await shard_for_list_id(list_id, directory)
+    async with shard_session(shard_id) as db:
+        tasks_list = await find_tasks_list(list_id, db)
 
-    result_tasks = await db.execute(
-        select(Task).where(Task.related_task_list == list_id)
-    )
-    tasks = result_tasks.scalars().all()
+        result_tasks = await db.execute(
+            select(Task).where(Task.related_task_list == list_id)
+        )
+        tasks = result_tasks.scalars().all()
 
     return {
         "tasks_list": {
@@ -131,11 +184,12 @@ async def patch_tasks_list(
     tasks_list: TasksListPatch,
     token: str = Depends(token_dependency),
     db: AsyncSession = Depends(get_db_session),
+    directory: AsyncSession = Depends(get_directory_session),
 ):
     user = await auth.validate_token(token, db)
     tasks_list = await find_tasks_list(list_id, db, user)
 
-    await if_list_title_already_exists(tasks_list.list_title, db)
+    await if_list_title_already_exists(tasks_list.list_title, directory)
 
     ...
 
@@ -153,7 +207,7 @@ async def delete_tasks_list(
 
     tasks_list.deleted_at = datetime.utcnow()
     db.add(tasks_list)
-    await db.commit()
+    await commit_user_write(db)
     return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "ok"})
 
 
@@ -177,7 +231,7 @@ async def delete_tasks_tasks_list(
         task.deleted_at = datetime.utcnow()
         db.add(task)
 
-    await db.commit()
+    await commit_user_write(db)
 
     return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "ok"})
 
@@ -208,6 +262,6 @@ async def delete_tasks_tasks_list(
         task.done = True
         db.add(task)
 
-    await db.commit()
+    await commit_user_write(db)
 
     return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "ok"})
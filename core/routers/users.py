@@ -4,18 +4,28 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from core.models import User, TasksList
-from core.database import get_db_session
+from core.models import User, TasksList, UserDirectory
+from core.database import (
+    bind_user,
+    commit_user_write,
+    get_directory_session,
+    shard_for_username,
+    shard_session,
+    shard_sessions,
+)
 from core.schemas import UserCreate, UserAuthorize, TasksListCreate
-from core.utils import auth
+from core.utils import auth, directory as directory_utils, idempotency
+from core.utils.idempotency import idempotency_key_dependency
 from uuid import UUID
 
 
 router = APIRouter()
 
 
-async def create_default_tasks_list(list_title: str, user: User, db):
+async def create_default_tasks_list(list_title: str, user: User, db, directory):
+    entry = await directory_utils.reserve_list_title(list_title, user.id, directory)
     new_tasks_list = TasksList(
+        id=entry.id,
         list_title=list_title,
         description=None,
         created_by=user.id,
@@ -24,75 +34,105 @@ async def create_default_tasks_list(list_title: str, user: User, db):
     )
 
     db.add(new_tasks_list)
-    await db.commit()
+    try:
+        await db.commit()
+    except BaseException:
+        await directory_utils.release(entry, directory)
+        raise
     await db.refresh(new_tasks_list)
 
 
 @router.post("/register")
-async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db_session)):
-    if user.password != user.confirm_password:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Passwords must match"
-        )
-
-    result = await db.execute(select(User).where(User.username == user.username))
-    existing_user = result.scalars().first()
-    if existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="User already exists",
-        )
-
-    hashed_password = User.hash_password(user.password)
-    new_user = User(username=user.username, hashed_password=hashed_password)
-    db.add(new_user)
-    await db.commit()
-    await db.refresh(new_user)
-
-    await create_default_tasks_list(
-        list_title=f"{user.username}'s default task-list", user=new_user, db=db
+async def create_user(
+    user: UserCreate,
+    idempotency_key: str = Depends(idempotency_key_dependency),
+    directory: AsyncSession = Depends(get_directory_session),
+):
+    async def handler():
+        if user.password != user.confirm_password:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Passwords must match"
+            )
+
+        entry = await directory_utils.reserve_user(user.username, directory)
+
+        hashed_password = User.hash_password(user.password)
+        try:
+            async with shard_session(entry.shard_id) as db:
+                new_user = User(
+                    id=entry.id, username=user.username, hashed_password=hashed_password
+                )
+                db.add(new_user)
+
+                # the user row is committed together with its default list
+                await create_default_tasks_list(
+                    list_title=f"{user.username}'s default task-list",
+                    user=new_user,
+                    db=db,
+                    directory=directory,
+                )
+                await db.refresh(new_user)
+        except BaseException:
+            await directory_utils.release(entry, directory)
+            raise
+
+        # the response is kept by the idempotency store, so it must not carry the hash
+        return new_user.model_dump(exclude={"hashed_password"})
+
+    return await idempotency.run_idempotent(
+        idempotency_key, "users:register", user, handler
     )
 
-    return new_user
-
 
 @router.post("/confirm/{confirmation_uuid}")
 async def confirm_user(
-    confirmation_uuid: UUID, db: AsyncSession = Depends(get_db_session)
+    confirmation_uuid: UUID, directory: AsyncSession = Depends(get_directory_session)
 ):
-    result = await db.execute(
-        select(User).where(User.confirmation_uuid == confirmation_uuid)
-    )
-    user = result.scalars().first()
-
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
-        )
-
-    if user.confirmed:
-        return JSONResponse(
-            status_code=status.HTTP_208_ALREADY_REPORTED,
-            content={"message": "User already confirmed"},
-        )
-
-    user.confirmed = True
-    db.add(user)
-    await db.commit()
-    await db.refresh(user)
-
-    return JSONResponse(
-        status_code=status.HTTP_202_ACCEPTED,
-        content={"message": f"User {user.username} confirmed"},
+    # the confirmation link carries no routing key, so every shard is checked
+    for shard_id in range(len(shard_sessions)):
+        async with shard_session(shard_id) as db:
+            result = await db.execute(
+                select(User).where(User.confirmation_uuid == confirmation_uuid)
+            )
+            user = result.scalars().first()
+
+            if not user:
+                continue
+
+            # skip copies left on a shard the user has been moved away from
+            entry = await directory.get(UserDirectory, user.id)
+            if not entry or entry.shard_id != shard_id:
+                continue
+
+            if user.confirmed:
+                return JSONResponse(
+                    status_code=status.HTTP_208_ALREADY_REPORTED,
+                    content={"message": "User already confirmed"},
+                )
+
+            user.confirmed = True
+            db.add(user)
+            await commit_user_write(bind_user(db, entry))
+            await db.refresh(user)
+
+            return JSONResponse(
+                status_code=status.HTTP_202_ACCEPTED,
+                content={"message": f"User {user.username} confirmed"},
+            )
+
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
     )
 
 
 @router.post("/auth")
 async def authorize_user(
-    user: UserAuthorize, db: AsyncSession = Depends(get_db_session)
+    user: UserAuthorize, directory: AsyncSession = Depends(get_directory_session)
 ):
-    result = await db.execute(select(User).where(User.username == user.username))
-    fetched_user = result.scalars().first()
+    shard_id = await shard_for_username(user.username, directory)
+    async with shard_session(shard_id) as db:
+        result = await db.execute(select(User).where(User.username == user.username))
+        fetched_user = result.scalars().first()
 
     if not fetched_user:
         raise HTTPException(
@@ -0,0 +1,62 @@
+from fastapi import HTTPException, status
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.database import shard_for_new_user
+from core.models import UserDirectory, TasksListDirectory, TaskDirectory
+
+
+async def _commit_entry(entry, directory: AsyncSession, error: HTTPException):
+    directory.add(entry)
+    try:
+        await directory.commit()
+    except IntegrityError:
+        await directory.rollback()
+        raise error
+    return entry
+
+
+async def reserve_user(username: str, directory: AsyncSession) -> UserDirectory:
+    """
+    function to claim a username and allocate the global user id
+    the entry also records the shard the user is placed on
+    """
+    return await _commit_entry(
+        UserDirectory(username=username, shard_id=shard_for_new_user(username)),
+        directory,
+        HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="User already exists",
+        ),
+    )
+
+
+async def reserve_list_title(
+    list_title: str, user_id: int, directory: AsyncSession
+) -> TasksListDirectory:
+    """
+    function to claim a list_title and allocate the global tasks list id
+    """
+    return await _commit_entry(
+        TasksListDirectory(list_title=list_title, user_id=user_id),
+        directory,
+        HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Tasks list with this title already exists",
+        ),
+    )
+
+
+async def reserve_task_id(user_id: int, directory: AsyncSession) -> TaskDirectory:
+    entry = TaskDirectory(user_id=user_id)
+    directory.add(entry)
+    await directory.commit()
+    return entry
+
+
+async def release(entry, directory: AsyncSession) -> None:
+    """
+    function to drop a reservation when the write to the shard failed
+    """
+    await directory.delete(entry)
+    await directory.commit()
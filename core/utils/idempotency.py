@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, Header, status
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+
+from core.database import async_session
+from core.models import IdempotencyRecord
+from core.utils.auth import SECRET_KEY
+
+load_dotenv()
+
+
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", 10_000))
+IDEMPOTENCY_USE_DB = os.getenv("IDEMPOTENCY_USE_DB", "false").lower() in ("1", "true", "yes")
+IDEMPOTENCY_LOCK_SECONDS = 60
+IDEMPOTENCY_POLL_INTERVAL = 0.1
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+class MemoryStore:
+    """
+    bounded in-memory cache of finished responses, keyed by scope + Idempotency-Key
+    entries share one TTL, so insertion order is also expiry order
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[float, str, Any]] = OrderedDict()
+        self.in_flight: dict[str, asyncio.Future] = {}
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            key, (expires_at, _, _) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            self._entries.pop(key)
+
+    def get(self, key: str) -> tuple[str, Any] | None:
+        self._evict()
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        _, fingerprint, response = entry
+        return fingerprint, response
+
+    def set(self, key: str, fingerprint: str, response: Any) -> None:
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, fingerprint, response)
+        self._evict()
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+store = MemoryStore(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL_SECONDS)
+
+
+async def idempotency_key_dependency(idempotency_key: str = Header(None)):
+    if idempotency_key is None:
+        return None
+    if not idempotency_key or len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid Idempotency-Key header",
+        )
+    return idempotency_key
+
+
+def _fingerprint(payload: Any) -> str:
+    encoded = json.dumps(jsonable_encoder(payload), sort_keys=True, default=str)
+    return hmac.new(
+        (SECRET_KEY or "").encode("utf-8"), encoded.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+
+def _replay(fingerprint: str, stored_fingerprint: str, response: Any) -> Any:
+    if fingerprint != stored_fingerprint:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Idempotency-Key was already used with a different request",
+        )
+    return response
+
+
+async def _claim_db_record(key: str, fingerprint: str) -> tuple[str, Any] | None:
+    """
+    function to claim the key in the idempotency table
+    returns None if the claim succeeded, otherwise waits for the worker
+    holding the claim and returns its stored fingerprint and response
+    expired keys of every scope are swept here, so the table stays bounded by the TTL
+    """
+    while True:
+        async with async_session() as session:
+            now = datetime.utcnow()
+            await session.execute(
+                delete(IdempotencyRecord).where(IdempotencyRecord.expires_at < now)
+            )
+            await session.commit()
+
+            record = await session.get(IdempotencyRecord, key)
+
+            stale = (
+                record
+                and record.response is None
+                and record.created_at < now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+            )
+            if stale:
+                await session.delete(record)
+                await session.commit()
+                record = None
+
+            if record is None:
+                session.add(
+                    IdempotencyRecord(
+                        key=key,
+                        fingerprint=fingerprint,
+                        created_at=now,
+                        expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS),
+                    )
+                )
+                try:
+                    await session.commit()
+                    return None
+                except IntegrityError:
+                    await session.rollback()
+                    continue
+
+            if record.response is not None:
+                return record.fingerprint, json.loads(record.response)
+
+        await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+
+async def _finish_db_record(key: str, response: Any | None) -> None:
+    """
+    function to store the response for a claimed key
+    pass None as the response to release the claim after a failure
+    """
+    async with async_session() as session:
+        record = await session.get(IdempotencyRecord, key)
+        if not record:
+            return
+        if response is None:
+            await session.delete(record)
+        else:
+            record.response = json.dumps(response)
+            session.add(record)
+        await session.commit()
+
+
+async def _execute(
+    key: str, fingerprint: str, handler: Callable[[], Awaitable[Any]]
+) -> Any:
+    if IDEMPOTENCY_USE_DB:
+        stored = await _claim_db_record(key, fingerprint)
+        if stored:
+            store.set(key, *stored)
+            return _replay(fingerprint, *stored)
+
+    try:
+        response = jsonable_encoder(await handler())
+    except BaseException:
+        if IDEMPOTENCY_USE_DB:
+            await _finish_db_record(key, None)
+        raise
+
+    if IDEMPOTENCY_USE_DB:
+        await _finish_db_record(key, response)
+    store.set(key, fingerprint, response)
+    return response
+
+
+async def run_idempotent(
+    idempotency_key: Optional[str],
+    scope: str,
+    payload: Any,
+    handler: Callable[[], Awaitable[Any]],
+) -> Any:
+    """
+    function to run a create handler at most once per Idempotency-Key
+    repeats get the stored response, concurrent duplicates wait for the first
+    execution; failed executions are not stored, so the next retry runs again
+    """
+    if not idempotency_key:
+        return await handler()
+
+    key = f"{scope}:{idempotency_key}"
+    fingerprint = _fingerprint(payload)
+
+    while True:
+        cached = store.get(key)
+        if cached:
+            return _replay(fingerprint, *cached)
+
+        in_flight = store.in_flight.get(key)
+        if in_flight is None:
+            break
+        await asyncio.shield(in_flight)
+
+    future = asyncio.get_running_loop().create_future()
+    store.in_flight[key] = future
+    try:
+        return await _execute(key, fingerprint, handler)
+    finally:
+        store.in_flight.pop(key, None)
+        future.set_result(None)